@@ -1,11 +1,12 @@
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 import os
 
 from datetime import datetime, timedelta
 from dateutil import tz
 from hdmf.backends.hdf5.h5_utils import H5DataIO
 from hdmf.data_utils import DataChunkIterator
-import matplotlib.pyplot as plt
+from hdmf.common import VectorData, VectorIndex
 import numpy as np
 import pandas as pd
 from pynwb import load_namespaces, get_class, register_class, NWBFile, TimeSeries, NWBHDF5IO
@@ -15,9 +16,10 @@ from pynwb.core import NWBDataInterface
 from pynwb.epoch import TimeIntervals
 from pynwb.behavior import SpatialSeries, Position
 from pynwb.image import ImageSeries
+import queue
 import scipy.io as sio
-import skimage.io as skio
 from tifffile import TiffFile
+import threading
 import time
 
 # ndx_mulitchannel_volume is the novel NWB extension for multichannel optophysiology in C. elegans
@@ -123,6 +125,24 @@ def create_image(name, description, data, ImVol, OptChanRefs, RGBW_channels=[0,1
 
     return image
 
+def build_voxel_masks(positions):
+
+    '''
+    Converts neuron center positions of shape (..., 3) into single voxel masks of shape (..., 4)
+    holding the XYZ coordinates and a weight of 1 for each ROI.
+
+    Neurons missing at a time point (NaN in any coordinate) get the mask [0,0,0,0], a weight of 0
+    marking missing data, rather than letting NaN pass through the cast to unsigned voxel coordinates.
+    '''
+
+    missing = np.isnan(positions).any(axis=-1)
+
+    voxels = np.empty(positions.shape[:-1] + (4,), dtype=np.uint32)
+    voxels[...,0:3] = np.where(missing[...,np.newaxis], 0, positions)
+    voxels[...,3] = ~missing  # add weight of 1 to each ROI that was found
+
+    return voxels
+
 def create_vol_seg_centers(name, description, ImagingVolume, positions, labels=None, reference_images = None):
 
     '''
@@ -135,25 +155,34 @@ def create_vol_seg_centers(name, description, ImagingVolume, positions, labels=N
     Labels should be an array of cellIDs in the same order as the neuron positions.
     '''
 
+    voxel_masks = build_voxel_masks(positions)
+
+    numrois = voxel_masks.shape[0]
+
+    voxel_mask = VectorData(
+        name = 'voxel_mask',
+        description = 'Voxel masks for each ROI: a list of indices and weights for the ROI.',
+        data = voxel_masks.tolist()
+    )
+
+    # each ROI has exactly one voxel, so ROI i ends at row i+1 of voxel_mask
+    voxel_mask_index = VectorIndex(
+        name = 'voxel_mask_index',
+        target = voxel_mask,
+        data = np.arange(1, numrois+1)
+    )
+
     vs = PlaneSegmentation(
         name = name,
         description = description,
         imaging_plane = ImagingVolume,
-        reference_images = reference_images
+        reference_images = reference_images,
+        id = np.arange(numrois),
+        columns = [voxel_mask, voxel_mask_index]
     )
 
-    for i in range(positions.shape[0]):
-        voxel_mask = []
-        x = positions[i,0]
-        y = positions[i,1]
-        z = positions[i,2]
-
-        voxel_mask.append([np.uint(x),np.uint(y),np.uint(z),1])  # add weight of 1 to each ROI
-
-        vs.add_roi(voxel_mask=voxel_mask)
-
     if labels is None:
-        labels = ['']*positions.shape[0]
+        labels = ['']*numrois
     else:
         vs.add_column(
             name = 'ID_labels',
@@ -165,10 +194,68 @@ def create_vol_seg_centers(name, description, ImagingVolume, positions, labels=N
 
     return vs
 
+def compress(data, compression, chunks=None):
+
+    '''
+    Wraps data in H5DataIO with the requested HDF5 compression. Compression can be False (no compression),
+    True/'lzf' (fastest writes, but the filter ships only with h5py so MatNWB and plain HDF5 cannot read it),
+    'gzip' (readable everywhere, use for archival runs and DANDI uploads) or 'blosc:zstd' (requires hdf5plugin).
+    '''
+
+    if not compression:
+        return data if chunks is None else H5DataIO(data=data, chunks=chunks)
+    if compression is True or compression == 'lzf':
+        return H5DataIO(data=data, compression="lzf", shuffle=True, chunks=chunks)
+    if compression == 'gzip':
+        return H5DataIO(data=data, compression="gzip", compression_opts=4, shuffle=True, chunks=chunks)
+    if compression == 'blosc:zstd':
+        import hdf5plugin
+        blosc = hdf5plugin.Blosc(cname='zstd', clevel=3, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        return H5DataIO(data=data, compression=blosc.filter_id, compression_opts=blosc.filter_options, allow_plugin_filters=True, chunks=chunks)
+
+    raise ValueError("compression must be False, True, 'lzf', 'gzip' or 'blosc:zstd', got " + repr(compression))
+
+def compress_roi_response(data, compression):
+
+    #Activity data of size (T,N) is stored as float32 in chunks of up to 1024 time points covering all ROIs,
+    #so reads of a time window touch only a few chunks
+    data = np.ascontiguousarray(data, dtype=np.float32)
+
+    return compress(data, compression, chunks=(min(1024, data.shape[0]), data.shape[1]))
+
+def create_vol_seg_series(name, description, ImagingVolume, positions, reference_images = None, compression = 'lzf'):
+
+    '''
+    Use this function to create a single volume segmentation for a whole calcium image series
+    where each ROI is one neuron tracked across all time points.
+
+    Positions should be a 3d array of size (N,T,3) where N is the number of neurons, T is the
+    number of time points and 3 refers to the XYZ coordinates of the neuron in that order.
+
+    The voxel_mask column holds the neuron centers at the first time point and the
+    positions_over_time column holds the centers at every time point as float32, with NaN
+    where a neuron is missing at a time point.
+    '''
+
+    vs = create_vol_seg_centers(name, description, ImagingVolume, positions[:,0,:], reference_images=reference_images)
+
+    positions_over_time = np.ascontiguousarray(positions, dtype=np.float32)
+
+    vs.add_column(
+        name = 'positions_over_time',
+        description = 'XYZ voxel coordinates of each ROI at every time point of the calcium image series, of size (N,T,3). NaN where a neuron is missing at a time point',
+        data = compress(positions_over_time, compression)
+    )
+
+    return vs
+
 def create_calc_series(name, data, description, comments,  device, imaging_volume, unit, scan_line_rate, dimension, rate, resolution, compression = False):
 
+    # compression takes the same values as compress
     if compression:
-        data = H5DataIO(data=data, compression="gzip", compression_opts=4)
+        # one chunk holds exactly one time point so each yielded volume is written (and later read) as a single chunk
+        frame_shape = data.maxshape[1:] if isinstance(data, DataChunkIterator) else np.shape(data)[1:]
+        data = compress(data, compression, chunks=(1,) + tuple(frame_shape))
 
     calcium_image_series = MultiChannelVolumeSeries(
         name = name,
@@ -189,30 +276,114 @@ def create_calc_series(name, data, description, comments,  device, imaging_volum
 def iter_calc_tiff(filename, numZ):
 
     #TiffFile object allows you to access metadata for the tif file and selectively load individual pages/series
-    tif = TiffFile(filename)
+    #The with block also closes the file if the generator is closed before reaching the last timepoint
+    with TiffFile(filename) as tif:
+
+        #In this dataset, one page is one XY plane and every 12 pages comprises one Z stack for an individual time point
+        pages = len(tif.pages)
+        timepoints = int(pages/numZ)
+
+        #We iterate through all of the timepoints and yield each timepoint back to the DataChunkIterator
+        for i in range(timepoints):
+            #Read the whole Z stack in one call, returned as (Z, Y, X), and reorder it to (X, Y, Z) in a single transpose
+            stack = tif.asarray(key=range(i*numZ, (i+1)*numZ))
+
+            #Make sure array ends up as the correct dtype coming out of this function (the dtype that your data was collected as)
+            #Each timepoint gets its own array so that it can be handed off through prefetch_iter while the next one is read
+            yield np.ascontiguousarray(stack.transpose(2,1,0), dtype='uint16')
+
+    return
+
 
-    #In this dataset, one page is one XY plane and every 12 pages comprises one Z stack for an individual time point
-    pages = len(tif.pages)
-    timepoints = int(pages/numZ)
+def stream_tiff(filename, axes=None, compression='lzf'):
 
-    pageshape = tif.pages[0].shape
+    #Decode the tif into a temporary memory mapped file rather than RAM, then write it to HDF5 one plane of the
+    #first (slowest) tif axis at a time so only one plane needs to be in memory. axes is the transpose applied to
+    #the image as skimage.io.imread returns it, by default reversing the order of the axes as np.transpose does.
+    with TiffFile(filename) as tif:
+        data = tif.asarray(out='memmap')
 
-    #We iterate through all of the timepoints and yield each timepoint back to the DataChunkIterator
-    for i in range(timepoints):
-        tpoint = np.zeros((pageshape[1],pageshape[0], numZ))
-        for j in range(numZ):
-            image = np.transpose(tif.pages[i*numZ+j].asarray())
-            tpoint[:,:,j] = image
+    #skimage.io.imread moves a (..., C, Y, X) channel axis of size 3 or 4 to the end, giving (..., Y, X, C).
+    #Apply the same reordering here so that axes refers to the same layout as before.
+    ndim = data.ndim
+    order = list(range(ndim))
+    if ndim > 2 and data.shape[-1] not in (3, 4) and data.shape[-3] in (3, 4):
+        order = order[:-3] + [ndim-2, ndim-1, ndim-3]
 
-        #Make sure array ends up as the correct dtype coming out of this function (the dtype that your data was collected as)
-        yield tpoint.astype('uint16')
+    if axes is None:
+        axes = tuple(range(ndim))[::-1]
 
-    tif.close()
+    #Fold both reorderings into a single transpose of the tif as it is stored
+    axes = tuple(order[ax] for ax in axes)
+
+    iter_axis = axes.index(0)
+    plane_axes = [ax-1 for ax in axes if ax != 0]
+    shape = tuple(data.shape[ax] for ax in axes)
+    chunks = tuple(1 if i == iter_axis else dim for i, dim in enumerate(shape))
+
+    planes = DataChunkIterator(
+        data = (data[i].transpose(plane_axes) for i in range(data.shape[0])),
+        maxshape = shape,
+        dtype = data.dtype,
+        iter_axis = iter_axis,
+        buffer_size = 1
+    )
+
+    return compress(planes, compression, chunks=chunks)
+
+def prefetch_iter(gen, depth=3):
+
+    #Runs gen on a background thread and keeps up to depth items queued, so that reading/decoding the next item
+    #(tifffile releases the GIL while decoding) overlaps with the consumer compressing and writing the current one
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        #Retry with a timeout rather than blocking, so the producer notices when the consumer has stopped early
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in gen:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as err:
+            put((None, err))
+        finally:
+            #Closing gen runs its cleanup, e.g. iter_calc_tiff closing its TiffFile
+            gen.close()
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, err = buffer.get()
+            if err is not None:
+                raise err
+            if item is done:
+                break
+            yield item
+    finally:
+        #Also reached when the consumer raises or drops this generator, stop the producer and free any queued items
+        stop.set()
+        thread.join()
+        while not buffer.empty():
+            buffer.get_nowait()
 
     return
 
 
-def process_NP_FOCO_Ray(datapath, dataset, strain):
+def process_NP_FOCO_Ray(datapath, dataset, strain, compression='lzf'):
 
     identifier = dataset
     session_description = 'NeuroPAL and calcium imaging of immobilized worm with optogenetic stimulus'
@@ -241,10 +412,11 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     microscope = create_device(nwbfile, microname, microdescrip, manufacturer)
 
     matfile = datapath + '/Manual_annotate/' +dataset +'/neuroPAL_image.mat'
-    mat = sio.loadmat(matfile)
-    scale = np.asarray(mat['info']['scale'][0][0]).flatten()
+    # only the image metadata is needed here, so skip loading the image data stored in the same file
+    mat = sio.loadmat(matfile, variable_names=['info'])
+    scale = np.ravel(mat['info']['scale'][0][0])
 
-    if folder <'20230322':
+    if dataset <'20230322':
         channels = [("mTagBFP2", "Chroma ET 460/50", "405-460-50m"), ("CyOFP1", "Chroma ET 605/70","488-605-70m"), ("GFP-GCaMP", "Chroma ET 525/50","488-525-50m"), ("mNeptune 2.5", "Chroma ET 700/75", "561-700-75m"), ("Tag RFP-T", "Chroma ET 605/70", "561-605-70m"), ("mNeptune 2.5-far red", "Chroma ET 700/75", "639-700-75m")]
         RGBW_channels = [0,1,3,4]
     else:
@@ -256,8 +428,8 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     NP_ImVol, NP_OptChanRef = create_im_vol(nwbfile, 'NeuroPALImVol', microscope, NP_descrip,channels, location="head", grid_spacing = scale)
 
     raw_file = datapath + '/NP_Ray/' + dataset + '/full_comp.tif'
-    data = skio.imread(raw_file)
-    data = np.transpose(data)
+    # reverse the axes of the image, written to the NWB file one plane at a time
+    data = stream_tiff(raw_file, compression=compression)
 
     ImDescrip = 'NeuroPAL structural image'
 
@@ -266,7 +438,7 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     nwbfile.add_acquisition(NP_image)
 
     blob_file = datapath + '/Manual_annotate/' + dataset + '/blobs.csv'
-    blobs = pd.read_csv(blob_file)
+    blobs = pd.read_csv(blob_file, usecols=['X', 'Y', 'Z', 'ID'], dtype={'X':np.float32, 'Y':np.float32, 'Z':np.float32})
 
     IDs = blobs['ID']
     labels = IDs.replace(np.nan,'',regex=True)
@@ -293,7 +465,7 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     Proc_ImVol, Proc_OptChanRef = create_im_vol(nwbfile, 'ProcessedImVol', microscope, Proc_descrip,[channels[i] for i in RGBW_channels])
 
     proc_file = datapath+ '/manual_annotate/' + dataset + '/neuroPAL_image.tif'
-    proc_data = np.transpose(skio.imread(proc_file), [2,1,0,3])
+    proc_data = stream_tiff(proc_file, (2,1,0,3), compression=compression)
 
     ProcDescrip = 'NeuroPAL image with median filtering followed by color histogram matching to reference NeuroPAL images'
 
@@ -309,7 +481,7 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
 
     GCaMP_chan = [("GFP-GCaMP", "Chroma ET 525/50","488-525-50m")]
 
-    if folder <'20230506':
+    if dataset <'20230506':
         Calc_scale = [0.3208, 0.3208, 2.5]
     else:
         Calc_scale = [0.1604, 0.1604, 3.0]
@@ -328,9 +500,9 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     numz = 12
 
     data = DataChunkIterator(
-        data = iter_calc_tiff(Calc_file, numz),
+        data = prefetch_iter(iter_calc_tiff(Calc_file, numz)),
         maxshape = None,
-        buffer_size = 10
+        buffer_size = 1
     )
 
     Calc_name = 'CalciumImageSeries'
@@ -341,46 +513,41 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     rate = 1.04
     resolution = 1.0
 
-    Calc_ImSeries = create_calc_series(Calc_name, data, description, comments, microscope,Calc_ImVol, Calc_unit, scan_line_rate, [numx, numy, numz], rate, resolution, compression=True)
+    Calc_ImSeries = create_calc_series(Calc_name, data, description, comments, microscope,Calc_ImVol, Calc_unit, scan_line_rate, [numx, numy, numz], rate, resolution, compression=compression)
 
     nwbfile.add_acquisition(Calc_ImSeries)
 
     gce_file = datapath + '/NP_Ray/' + dataset +'/extractor-objects/' + dataset + '_gce_quantification.csv'
 
-    gce_quant = pd.read_csv(gce_file)
-
-    gce_df = gce_quant[['X', 'Y', 'Z', 'gce_quant', 'ID', 'T', 'blob_ix']]
+    # only parse the columns that are used, with explicit dtypes so pandas does not have to infer them over every row
+    gce_quant = pd.read_csv(gce_file, usecols=['X', 'Y', 'Z', 'gce_quant', 'T', 'blob_ix'],
+                            dtype={'X':np.float32, 'Y':np.float32, 'Z':np.float32, 'gce_quant':np.float32, 'T':np.int32, 'blob_ix':np.int32})
 
-    blobquant = None
-    for idx in gce_quant['blob_ix'].unique():
-        blob = gce_df[gce_df['blob_ix']==idx]
-        blobarr = np.asarray(blob[['X','Y','Z','gce_quant','ID']]) 
-        blobarr = blobarr[np.newaxis, :, :]
-        if blobquant is None:
-            blobquant=blobarr
+    gce_df = gce_quant.sort_values(['blob_ix', 'T'])
 
-        else:
-            blobquant = np.vstack((blobquant, blobarr))
+    # every blob must be tracked through every time point, so once sorted by blob and then time the table is just a (blobs, T, 4) array.
+    # with no repeated (blob_ix, T) pairs, having blobs*T rows means every blob has exactly one row for each time point
+    n_blobs = gce_df['blob_ix'].nunique()
+    n_t = gce_df['T'].nunique()
+    if gce_df.duplicated(['blob_ix', 'T']).any():
+        raise ValueError(gce_file + ' has more than one row for the same blob_ix and T')
+    if len(gce_df) != n_blobs*n_t:
+        raise ValueError('each blob in ' + gce_file + ' must have one row for every time point')
 
-    volsegs = []
+    # the text ID column is left out so blobquant is a single float32 allocation rather than an object array
+    blobquant = gce_df[['X','Y','Z','gce_quant']].to_numpy(dtype=np.float32).reshape(n_blobs, n_t, 4)
 
-    for t in range(blobquant.shape[1]):
-        blobs = np.squeeze(blobquant[:,t,0:3])
-
-        vsname = 'Seg_tpoint_'+str(t)
-        description = 'Neuron segmentation for time point ' +str(t) + ' in calcium image series'
-        volseg = create_vol_seg_centers(vsname, description, Calc_ImVol, blobs, reference_images=Calc_ImSeries)
-
-        volsegs.append(volseg)
+    description = 'Neuron segmentation for every time point in calcium image series'
+    volseg = create_vol_seg_series('CalciumSeriesNeurons', description, Calc_ImVol, blobquant[:,:,0:3], reference_images=Calc_ImSeries, compression=compression)
 
     CalcImSeg = ImageSegmentation(
         name = 'CalciumSeriesSegmentation',
-        plane_segmentations = volsegs
+        plane_segmentations = volseg
     )
 
     gce_data = np.transpose(blobquant[:,:,3])
 
-    rt_region = volsegs[0].create_roi_table_region(
+    rt_region = volseg.create_roi_table_region(
         description = 'Segmented neurons associated with calcium image series. This rt_region uses the location of the neurons at the first time point',
         region = list(np.arange(blobquant.shape[0]))
     )
@@ -388,7 +555,7 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     RoiResponse = RoiResponseSeries( # CHANGE WITH FEEDBACK FROM RAY
         name = 'SignalCalciumImResponseSeries',
         description = 'DF/F activity for calcium imaging data',
-        data = gce_data,
+        data = compress_roi_response(gce_data, compression),
         rois = rt_region,
         unit = 'Percentage',
         rate = 1.04
@@ -408,11 +575,29 @@ def process_NP_FOCO_Ray(datapath, dataset, strain):
     calcium_im_module.add(SignalFluor)
     calcium_im_module.add(Calc_OptChanRef)
 
-    io = NWBHDF5IO(datapath + '/NWB_Ray/'+identifier+'.nwb', mode='w')
-    io.write(nwbfile)
-    io.close()
+    with NWBHDF5IO(datapath + '/NWB_Ray/'+identifier+'.nwb', mode='w') as io:
+        io.write(nwbfile)
+
+def run_NP_FOCO_Ray(datapath, dataset, strain, compression):
+
+    #Worker for the process pool in __main__, each dataset is written to its own NWB file so they can be converted in parallel
+    t0 = time.time()
+    process_NP_FOCO_Ray(datapath, dataset, strain, compression)
+    t1 = time.time()
+    print(dataset, t1-t0)
 
-def process_yemini(folder):
+def swap_xy(positions):
+
+    #Swaps the first two coordinates of an (N,T,3) position array while casting to the float32 positions stored in
+    #the segmentation, so each array is copied once rather than once by fancy indexing and again by the cast
+    swapped = np.empty(positions.shape, dtype=np.float32)
+    swapped[...,0] = positions[...,1]
+    swapped[...,1] = positions[...,0]
+    swapped[...,2] = positions[...,2]
+
+    return swapped
+
+def process_yemini(folder, compression='lzf'):
     worm = folder.split('/')[-1]
 
     matfile = folder + '/head.mat'
@@ -423,10 +608,19 @@ def process_yemini(folder):
     oldact = folder +'/old_act.mat'
     oldpos = folder +'/old_pos.mat'
 
-    mat = sio.loadmat(matfile)
-    gcamp = sio.loadmat(gcampfile)
+    # load the metadata separately from the image so the float image can be freed as soon as it is rescaled,
+    # before the calcium data is loaded
+    mat = sio.loadmat(matfile, variable_names=['info', 'prefs'])
 
-    data = np.transpose(mat['data']*4095, (1,0,2,3))
+    # rescale the normalized image back to 12 bit gray counts, one channel at a time straight into the transposed
+    # uint16 array so that no full size scaled float copy of the volume is made
+    src = np.transpose(sio.loadmat(matfile, variable_names=['data'])['data'], (1,0,2,3))
+    data = np.empty(src.shape, dtype=np.uint16)
+    for c in range(src.shape[3]):
+        data[:,:,:,c] = np.rint(src[:,:,:,c]*4095)
+    del src
+
+    gcamp = sio.loadmat(gcampfile, variable_names=['data', 'worm_data'])
 
     gcdata = gcamp['data']
 
@@ -440,10 +634,10 @@ def process_yemini(folder):
     ydim = gcdata.shape[2]
     zdim = gcdata.shape[3]
 
-    scale = np.asarray(mat['info']['scale'][0][0]).flatten()
-    prefs = np.asarray(mat['prefs']['RGBW'][0][0]).flatten()-1 #subtract 1 to adjust for matlab indexing from 1
+    scale = np.ravel(mat['info']['scale'][0][0])
+    prefs = np.ravel(mat['prefs']['RGBW'][0][0])-1 #subtract 1 to adjust for matlab indexing from 1
     
-    gcscale = np.asarray(gcamp['worm_data']['info'][0][0][0][0][1]).flatten()
+    gcscale = np.ravel(gcamp['worm_data']['info'][0][0][0][0][1])
 
     session_start = datetime(int(worm[0:4]),int(worm[4:6]),int(worm[6:8]), tzinfo=tz.gettz("US/Pacific"))
 
@@ -477,14 +671,10 @@ def process_yemini(folder):
 
     csv = pd.read_csv(csvfile, skiprows=6)
 
-    blobs = csv[['Real X (um)', 'Real Y (um)', 'Real Z (um)', 'User ID']]
-    blobs = blobs.rename(columns={'Real X (um)':'X', 'Real Y (um)':'Y', 'Real Z (um)':'Z', 'User ID':'ID'})
-    blobs['X'] = round(blobs['X'].div(scale[0]))
-    blobs['Y'] = round(blobs['Y'].div(scale[1]))
-    blobs['Z'] = round(blobs['Z'].div(scale[2]))
-    blobs = blobs.astype({'X':'uint16', 'Y':'uint16', 'Z':'uint16'})
-    pos = np.asarray(blobs[['X', 'Y', 'Z']])
-    IDs = blobs['ID']
+    # convert real positions in um to voxel coordinates in one vectorized step
+    xyz = csv[['Real X (um)', 'Real Y (um)', 'Real Z (um)']].to_numpy()
+    pos = np.rint(xyz / scale[:3]).astype(np.uint16)
+    IDs = csv['User ID']
     labels = IDs.replace(np.nan, '', regex=True)
     labels = list(np.asarray(labels))
 
@@ -528,43 +718,28 @@ def process_yemini(folder):
 
     nwbfile.add_acquisition(Calc_ImSeries)
 
-    positions = positiondata[:,:,[1,0,2]] #switch first two columns so that x is first in accordance with image data
-    raw_pos = oldpos[:,:,[1,0,2]]
+    positions = swap_xy(positiondata) #switch first two columns so that x is first in accordance with image data
+    raw_pos = swap_xy(oldpos)
 
-    volsegs = []
-
-    for t in range(raw_pos.shape[1]):
-        blobs = np.squeeze(raw_pos[:,t,:])
-
-        vsname = 'Seg_tpoint_'+str(t)
-        description = 'Neuron segmentation for time point ' +str(t) + ' in calcium image series'
-        volseg = create_vol_seg_centers(vsname, description, Calc_ImVol, blobs, reference_images=Calc_ImSeries)
-
-        volsegs.append(volseg)
+    description = 'Neuron segmentation for every time point in calcium image series'
+    volseg = create_vol_seg_series('CalciumSeriesNeurons', description, Calc_ImVol, raw_pos, reference_images=Calc_ImSeries, compression=compression)
 
     CalcImSeg = ImageSegmentation(
         name = 'CalciumSeriesSegmentation',
-        plane_segmentations = volsegs
+        plane_segmentations = volseg
     )
 
-    procvolsegs = []
-    for t in range(positions.shape[1]):
-        blobs = np.squeeze(positions[:,t,:])
-
-        vsname = 'Seg_tpoint_'+str(t)
-        description = 'Neuron positions for time point ' +str(t) + ' calculated via dNMF'
-        volseg = create_vol_seg_centers(vsname, description, Calc_ImVol, blobs, reference_images=Calc_ImSeries)
-
-        procvolsegs.append(volseg)
+    description = 'Neuron positions for every time point calculated via dNMF'
+    procvolseg = create_vol_seg_series('CalciumSeriesNeurons', description, Calc_ImVol, positions, reference_images=Calc_ImSeries, compression=compression)
 
     ProcCalcImSeg = ImageSegmentation(
         name = 'CalciumSeriesSegmentationdNMF',
-        plane_segmentations = procvolsegs
+        plane_segmentations = procvolseg
     )
 
     gce_data = np.transpose(activitydata)
 
-    rt_region = volsegs[0].create_roi_table_region(
+    rt_region = volseg.create_roi_table_region(
         description = 'Segmented neurons associated with calcium image series. This rt_region uses the location of the neurons at the first time point',
         region = list(np.arange(positions.shape[0]))
     )
@@ -572,7 +747,7 @@ def process_yemini(folder):
     RoiResponse = RoiResponseSeries( # CHANGE WITH FEEDBACK FROM RAY
         name = 'SignalCalciumImResponseSeries',
         description = 'Raw fluorescence activity for calcium imaging data',
-        data = gce_data,
+        data = compress_roi_response(gce_data, compression),
         rois = rt_region,
         unit = 'unitless',
         rate = 4.0
@@ -586,7 +761,7 @@ def process_yemini(folder):
     RoiResponsedNMF = RoiResponseSeries( # CHANGE WITH FEEDBACK FROM RAY
         name = 'dNMFCalciumImResponseSeries',
         description = 'Raw fluorescence activity data computed using dNMF',
-        data = gce_data,
+        data = compress_roi_response(gce_data, compression),
         rois = rt_region,
         unit = 'unitless',
         rate = 4.0
@@ -608,13 +783,15 @@ def process_yemini(folder):
     calcium_im_module.add(dNMFFluor)
     calcium_im_module.add(Calc_OptChanRef)
 
-    io = NWBHDF5IO(datapath + '/Yemini_NWB/'+worm+'.nwb', mode='w')
-    io.write(nwbfile)
-    io.close()
+    with NWBHDF5IO(datapath + '/Yemini_NWB/'+worm+'.nwb', mode='w') as io:
+        io.write(nwbfile)
 
 if __name__ == '__main__':
     datapath = '/Users/danielysprague/foco_lab/data'
 
+    #use 'gzip' for archival runs and files going to DANDI, lzf is faster to write but can only be read through h5py
+    compression = 'lzf'
+
     
     strain_dict = {'20221028-18-48-00':'FC121', '20221106-21-00-09':'FC121', '20221106-21-23-19':'FC121',
                    '20221106-21-23-19':'FC121', '20221106-21-47-31':'FC121', '20221215-20-02-49':'FC121',
@@ -624,22 +801,24 @@ if __name__ == '__main__':
                    '20230506-15-01-45':'OH16230', '20230506-15-33-51':'OH16230', '20230510-12-53-34':'FC121',
                    '20230510-13-25-46':'FC121', '20230510-15-49-47':'FC128', '20230510-16-36-46':'FC128'}
 
-    for folder in os.listdir(datapath+'/NP_Ray'):
-        if folder == '.DS_Store':
-            continue
-        strain = strain_dict[folder]
-        print(folder)
-        t0 = time.time()
-        process_NP_FOCO_Ray(datapath, folder, strain)
-        t1 = time.time()
-        print(t1-t0)
+    #scandir entries already know whether they are directories, so files like .DS_Store are skipped without a stat per entry
+    datasets = [entry.name for entry in os.scandir(datapath+'/NP_Ray') if entry.is_dir()]
+    folders = [folder for folder in datasets if folder in strain_dict]
+    for folder in set(datasets) - set(folders):
+        print('skipping ' + folder + ', no strain listed in strain_dict')
+    strains = [strain_dict[folder] for folder in folders]
+
+    #Datasets are independent so convert them in separate processes, leaving half of the cores for HDF5 compression and I/O
+    max_workers = max(1, min((os.cpu_count() or 2)//2, len(folders)))
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        list(ex.map(run_NP_FOCO_Ray, [datapath]*len(folders), folders, strains, [compression]*len(folders)))
     '''
     for folder in os.listdir(datapath+'/Yemini_21/OH16230/Heads'):
         if folder == '.DS_Store':
             continue
         print(folder)
         t0 = time.time()
-        process_yemini(datapath + '/Yemini_21/OH16230/Heads/'+folder)
+        process_yemini(datapath + '/Yemini_21/OH16230/Heads/'+folder, compression)
         t1 = time.time()
         print(t1-t0)
     '''
\ No newline at end of file
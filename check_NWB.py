@@ -24,4 +24,4 @@ class test_NWB():
             calcium_frames = read_nwbfile.acquisition['CalciumImageSeries'].data[0:15, :,:,:] #load the first 15 frames of the calcium images
             print(read_nwbfile.acquisition['CalciumImageSeries'].dimension[:])
             fluor = read_nwbfile.processing['CalciumActivity']['Fluorescence']['GCaMP_activity'].data[:]
-            #calc_seg = read_nwbfile.processing['CalciumActivity']['CalciumSeriesSegmentation']['Seg_tpoint_0'].voxel_mask[:]
\ No newline at end of file
+            #calc_seg = read_nwbfile.processing['CalciumActivity']['CalciumSeriesSegmentation']['CalciumSeriesNeurons']['positions_over_time'].data[:]
\ No newline at end of file